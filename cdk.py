@@ -1,35 +1,249 @@
+import functools
+import gzip
+import ipaddress
 import os
-from typing import Self
-
-import aws_cdk as cdk
-import aws_cdk.aws_ec2 as ec2
-import aws_cdk.aws_ecr_assets as ecr_assets
-import aws_cdk.aws_efs as efs
-import aws_cdk.aws_eks as eks
-import aws_cdk.aws_iam as iam
-import aws_cdk.aws_rds as rds
-from aws_cdk import custom_resources as cr
-import yaml
-from aws_cdk.lambda_layer_kubectl import KubectlLayer
-from constructs import Construct
-from typing import Optional
-import requests
-
-from jinja2 import Environment
-from jinja2.loaders import FileSystemLoader
-
-jinja_env = Environment(loader=FileSystemLoader("templates"))
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Optional, Self, cast
+
+# Hand the cli the cloud assembly from the last synth instead of rebuilding it, e.g. `CDK_SKIP_SYNTH=1 cdk diff`.
+# Checked before aws_cdk is imported, as loading its jsii assembly takes up most of the time a synth does.
+if __name__ == "__main__" and os.environ.get("CDK_SKIP_SYNTH") == "1":
+    if Path(os.environ.get("CDK_OUTDIR", "cdk.out"), "manifest.json").exists():
+        sys.exit(0)
+
+import aws_cdk as cdk  # noqa: E402
+import aws_cdk.aws_ec2 as ec2  # noqa: E402
+import aws_cdk.aws_ecr_assets as ecr_assets  # noqa: E402
+import aws_cdk.aws_efs as efs  # noqa: E402
+import aws_cdk.aws_eks as eks  # noqa: E402
+import aws_cdk.aws_iam as iam  # noqa: E402
+import aws_cdk.aws_rds as rds  # noqa: E402
+import yaml  # noqa: E402
+from aws_cdk import custom_resources as cr  # noqa: E402
+from aws_cdk.lambda_layer_kubectl import KubectlLayer  # noqa: E402
+from constructs import Construct  # noqa: E402
+from jinja2 import Environment, FileSystemBytecodeCache  # noqa: E402
+from jinja2.loaders import FileSystemLoader  # noqa: E402
 
 # CIDR block used for kubernetes cluster services
 # CDK DOCS> The CIDR block to assign Kubernetes service IP addresses from. Default: -
 # CDK DOCS> Kubernetes assigns addresses from either the 10.100.0.0/16 or 172.20.0.0/16 CIDR blocks
 CLUSTER_SERVICE_IPV4_CIDR = "172.20.0.0/16"
 
+# CIDR block of the VPC, when this app creates it. Matches the CDK default, but is set explicitly so security group
+# rules can use the literal instead of a cross stack reference to the VPC's CidrBlock attribute.
+VPC_IPV4_CIDR = "10.0.0.0/16"
+
+# CIDR block of the VPN clients connect from
+VPN_IPV4_CIDR = "10.0.0.0/8"
+
 
 SYSTEM_AUTOSCALING_GROUP_MIN_SIZE = 1
 SYSTEM_AUTOSCALING_GROUP_MAX_SIZE = 5
-USER_AUTOSCALING_GROUP_MIN_SIZE = 0
-USER_AUTOSCALING_GROUP_MAX_SIZE = 10
+
+# Version of the Karpenter helm chart, which provisions the nodes user servers run on
+KARPENTER_VERSION = "1.0.6"
+# Total vCPUs of all user nodes, e.g. 10 m7i.xlarge nodes
+USER_NODE_POOL_CPU_LIMIT = 40
+
+# IAM actions used by the cluster-autoscaler, which only scales the system node group
+CLUSTER_AUTOSCALER_ACTIONS = [
+    "autoscaling:DescribeAutoScalingGroups",
+    "autoscaling:DescribeAutoScalingInstances",
+    "autoscaling:DescribeLaunchConfigurations",
+    "autoscaling:DescribeScalingActivities",
+    "autoscaling:DescribeTags",
+    "ec2:DescribeInstanceTypes",
+    "ec2:DescribeLaunchTemplateVersions",
+    "autoscaling:SetDesiredCapacity",
+    "autoscaling:TerminateInstanceInAutoScalingGroup",
+    "ec2:DescribeImages",
+    "ec2:GetInstanceTypesFromInstanceRequirements",
+    "eks:DescribeNodegroup",
+]
+
+# Read only IAM actions used by the Karpenter controller, granted in the cluster's region only
+KARPENTER_REGIONAL_READ_ACTIONS = [
+    "ec2:DescribeAvailabilityZones",
+    "ec2:DescribeImages",
+    "ec2:DescribeInstanceTypeOfferings",
+    "ec2:DescribeInstanceTypes",
+    "ec2:DescribeInstances",
+    "ec2:DescribeLaunchTemplates",
+    "ec2:DescribeSecurityGroups",
+    "ec2:DescribeSpotPriceHistory",
+    "ec2:DescribeSubnets",
+]
+
+CLUSTER_AUTOSCALER_MANIFEST_URL = "https://raw.githubusercontent.com/kubernetes/autoscaler/master/cluster-autoscaler/cloudprovider/aws/examples/cluster-autoscaler-autodiscover.yaml"
+# How long, in seconds, a cached copy of the cluster-autoscaler manifest is used before revalidating it
+CLUSTER_AUTOSCALER_MANIFEST_MAX_AGE = 24 * 60 * 60
+
+# Directory used to cache inputs between synths. CDK re-runs this app for every cli command.
+CACHE_DIR = Path("cdk.out", ".cache")
+
+
+@functools.cache
+def _yaml_loader() -> type:
+    """The libyaml backed safe loader if available, it is much faster than the pure python implementation."""
+    require_libyaml = os.environ.get("REQUIRE_LIBYAML", "").lower() in ("1", "on", "true")
+    if require_libyaml and not yaml.__with_libyaml__:
+        raise ImportError("PyYAML was built without libyaml, unset REQUIRE_LIBYAML to fall back to the python loader")
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@functools.cache
+def _jinja():
+    """The jinja environment for the files in `templates`.
+
+    Compiled templates are cached on disk, and templates aren't expected to change while the app is running.
+    """
+    (CACHE_DIR / "jinja").mkdir(parents=True, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader("templates"),
+        bytecode_cache=FileSystemBytecodeCache(directory=str(CACHE_DIR / "jinja")),
+        auto_reload=False,
+    )
+
+
+def _load_autoscaler_manifest(max_age: Optional[float] = CLUSTER_AUTOSCALER_MANIFEST_MAX_AGE) -> str:
+    """Fetch the upstream cluster-autoscaler manifest, caching it on disk between synths.
+
+    A cached copy is used as is for max_age seconds, then revalidated with its ETag. If max_age is None, or the manifest
+    can't be fetched, any cached copy is used regardless of its age.
+    """
+    cache_file = CACHE_DIR / "cluster-autoscaler-autodiscover.yaml"
+    etag_file = cache_file.with_suffix(".etag")
+    try:
+        if max_age is None or time.time() - cache_file.stat().st_mtime < max_age:
+            return cache_file.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        pass
+
+    headers = {"Accept-Encoding": "gzip"}
+    if cache_file.exists() and etag_file.exists():
+        headers["If-None-Match"] = etag_file.read_text(encoding="utf-8")
+    request = urllib.request.Request(CLUSTER_AUTOSCALER_MANIFEST_URL, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            content = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                content = gzip.decompress(content)
+            etag = response.headers.get("ETag")
+    except OSError as e:
+        # urlopen raises HTTPError for a 304 too
+        if not cache_file.exists():
+            raise
+        if isinstance(e, urllib.error.HTTPError) and e.code == 304:
+            cache_file.touch()
+        return cache_file.read_text(encoding="utf-8")
+
+    _write_cache_file(cache_file, content)
+    if etag:
+        _write_cache_file(etag_file, etag.encode())
+    return content.decode("utf-8")
+
+
+def _write_cache_file(path: Path, data: bytes):
+    """Atomically write `data` to `path`, so concurrent synths never read a partially written cache file."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_bytes(data)
+    os.replace(tmp_file, path)
+
+
+def _deep_merge(base: dict, patch: dict) -> dict:
+    """Return a copy of `base` with `patch` merged into it, merging nested dicts rather than replacing them."""
+    merged = base | patch
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merged[key] = _deep_merge(base[key], value)
+    return merged
+
+
+def _collapse_cidrs(cidrs: dict[str, str]) -> dict[str, str]:
+    """Drop the CIDR blocks that duplicate an earlier block in `cidrs`.
+
+    Overlapping blocks that aren't identical are all kept, so each source keeps its own rule.
+
+    Args:
+        cidrs: CIDR blocks keyed by a description of their source. Unresolved tokens are always kept, as their range
+            isn't known until deploy time.
+    """
+    seen = set()
+    collapsed = {}
+    for source, cidr in cidrs.items():
+        if not cdk.Token.is_unresolved(cidr):
+            network = ipaddress.ip_network(cidr, strict=False)
+            if network in seen:
+                continue
+            seen.add(network)
+        collapsed[source] = cidr
+    return collapsed
+
+
+def _add_client_ingress_rules(security_group: ec2.SecurityGroup, vpc_cidr_block: str, port: ec2.Port, protocol: str):
+    """Allow inbound traffic on `port` from the VPC, the VPN and the EKS cluster.
+
+    Args:
+        security_group: Security group to add the rules to
+        vpc_cidr_block: CIDR block of the vpc, a literal when known at synth time
+        port: Port to allow traffic to
+        protocol: Name of the protocol served on `port`, used in the rule descriptions
+    """
+    ingress_cidrs = {"VPC": vpc_cidr_block, "VPN": VPN_IPV4_CIDR, "EKS cluster": CLUSTER_SERVICE_IPV4_CIDR}
+    for source, cidr in _collapse_cidrs(ingress_cidrs).items():
+        security_group.add_ingress_rule(
+            ec2.Peer.ipv4(cidr),
+            port,
+            description=f"Allow all inbound {protocol} traffic from {source}.",
+        )
+
+
+def _docker_cache_options(name: str) -> dict:
+    """BuildKit cache settings for a docker image asset, if a cache repository is configured.
+
+    Set DOCKER_CACHE_REPOSITORY to the uri of an ECR repository to reuse image layers between builds, e.g. on CI
+    runners without a warm local docker cache. Exporting a registry cache requires a docker-container buildx builder.
+    """
+    repository = os.environ.get("DOCKER_CACHE_REPOSITORY")
+    if not repository:
+        return {}
+    ref = f"{repository}:{name}"
+    return {
+        "cache_from": [ecr_assets.DockerCacheOption(type="registry", params={"ref": ref})],
+        "cache_to": ecr_assets.DockerCacheOption(
+            type="registry",
+            params={"ref": ref, "mode": "max", "image-manifest": "true", "oci-mediatypes": "true"},
+        ),
+    }
+
+
+def _docker_image(scope: Construct, id: str, file: str, **kwargs) -> ecr_assets.DockerImageAsset:
+    """Build one of the Dockerfiles in `images` as an image asset.
+
+    The other Dockerfiles are excluded from the build context, so that changing one image doesn't change the asset hash
+    of, and rebuild and republish, all of them.
+
+    Args:
+        id: Construct id of the asset
+        file: Name of the Dockerfile in `images`
+        kwargs: Additional DockerImageAsset properties
+    """
+    return ecr_assets.DockerImageAsset(
+        scope,
+        id,
+        directory="images",
+        file=file,
+        exclude=["*.Dockerfile", f"!{file}"],
+        platform=ecr_assets.Platform.LINUX_AMD64,
+        **_docker_cache_options(file.removesuffix(".Dockerfile")),
+        **kwargs,
+    )
 
 
 class Vpc(cdk.Stack):
@@ -44,8 +258,13 @@ class Vpc(cdk.Stack):
         super().__init__(scope, id, **kwargs)
         if vpc_id is not None:
             self.vpc = ec2.Vpc.from_lookup(self, "Vpc", vpc_id=vpc_id)
+            self.vpc_cidr_block = self.vpc.vpc_cidr_block
         else:
-            self.vpc = ec2.Vpc(self, "Vpc")
+            self.vpc = ec2.Vpc(self, "Vpc", ip_addresses=ec2.IpAddresses.cidr(VPC_IPV4_CIDR))
+            self.vpc_cidr_block = VPC_IPV4_CIDR
+            # Database and FileSystem used to import the VPC's CidrBlock. Keep exporting it, so deploying this stack
+            # first doesn't try to delete an export those stacks still import. See "Upgrading" in the README.
+            self.export_value(self.vpc.vpc_cidr_block)
 
 
 class Database(cdk.Stack):
@@ -54,6 +273,7 @@ class Database(cdk.Stack):
         scope: Construct,
         id: str,
         vpc: ec2.Vpc,
+        vpc_cidr_block: str,
         removal_policy: cdk.RemovalPolicy,
         instance_type: ec2.InstanceType,
         **kwargs,
@@ -62,6 +282,7 @@ class Database(cdk.Stack):
 
         Args:
             vpc_id: ID of the vpc in which to create this database
+            vpc_cidr_block: CIDR block of the vpc, a literal when known at synth time
             removal_policy: cdk removal policy for resources in this stack
             instance_type: Ec2 instance type of this db instance
         """
@@ -72,23 +293,7 @@ class Database(cdk.Stack):
             vpc=vpc,
             allow_all_outbound=True,
         )
-        self.security_group.add_ingress_rule(
-            ec2.Peer.ipv4(vpc.vpc_cidr_block),
-            ec2.Port.tcp(5432),
-            description="Allow all inbound postgres traffic from VPC.",
-        )
-
-        self.security_group.add_ingress_rule(
-            ec2.Peer.ipv4("10.0.0.0/8"),
-            ec2.Port.tcp(5432),
-            description="Allow all inbound postgres traffic from VPN.",
-        )
-
-        self.security_group.add_ingress_rule(
-            ec2.Peer.ipv4(CLUSTER_SERVICE_IPV4_CIDR),
-            ec2.Port.tcp(5432),
-            description="Allow all inbound postgres traffic from EKS cluster.",
-        )
+        _add_client_ingress_rules(self.security_group, vpc_cidr_block, ec2.Port.tcp(5432), "postgres")
 
         self.db = rds.DatabaseInstance(
             self,
@@ -110,6 +315,7 @@ class FileSystem(cdk.Stack):
         scope: Construct,
         id: str,
         vpc: ec2.Vpc,
+        vpc_cidr_block: str,
         removal_policy: cdk.RemovalPolicy,
         automatic_backups: bool,
         **kwargs,
@@ -118,6 +324,7 @@ class FileSystem(cdk.Stack):
 
         Args:
             vpc_id: ID of the vpc in which to create this application
+            vpc_cidr_block: CIDR block of the vpc, a literal when known at synth time
             removal_policy: cdk removal policy for resources in this stack
             automatic_backups: Whether or not to enable automatic backups for the EFS file system
         """
@@ -130,23 +337,7 @@ class FileSystem(cdk.Stack):
             vpc=vpc,
             allow_all_outbound=True,
         )
-        efs_security_group.add_ingress_rule(
-            ec2.Peer.ipv4(vpc.vpc_cidr_block),
-            ec2.Port.tcp(2049),
-            description="Allow all inbound NFS traffic from VPC.",
-        )
-
-        efs_security_group.add_ingress_rule(
-            ec2.Peer.ipv4("10.0.0.0/8"),
-            ec2.Port.tcp(2049),
-            description="Allow all inbound NFS traffic from VPN.",
-        )
-
-        efs_security_group.add_ingress_rule(
-            ec2.Peer.ipv4(CLUSTER_SERVICE_IPV4_CIDR),
-            ec2.Port.tcp(2049),
-            description="Allow all inbound NFS traffic from EKS cluster.",
-        )
+        _add_client_ingress_rules(efs_security_group, vpc_cidr_block, ec2.Port.tcp(2049), "NFS")
 
         self.file_system = efs.FileSystem(
             self,
@@ -154,6 +345,8 @@ class FileSystem(cdk.Stack):
             vpc=vpc,
             lifecycle_policy=efs.LifecyclePolicy.AFTER_14_DAYS,
             out_of_infrequent_access_policy=efs.OutOfInfrequentAccessPolicy.AFTER_1_ACCESS,
+            # Notebook workloads are many small, bursty reads, which quickly exhaust bursting mode's credits
+            throughput_mode=efs.ThroughputMode.ELASTIC,
             removal_policy=removal_policy,
             security_group=efs_security_group,
             enable_automatic_backups=automatic_backups,
@@ -171,10 +364,20 @@ class Application(cdk.Stack):
         hub_db_secret_arn: str,
         user_node_instance_type: ec2.InstanceType,
         system_node_instance_type: ec2.InstanceType,
+        stack_outputs: bool = True,
         **kwargs,
     ) -> Self:
-        """Initialize a jupyterhub environment running on an EKS cluster."""
+        """Initialize a jupyterhub environment running on an EKS cluster.
+
+        Args:
+            stack_outputs: Whether to emit the cluster access, user role and endpoint stack outputs
+        """
         super().__init__(scope, id, **kwargs)
+
+        # Each of these is a round trip to the jsii kernel, look them up once
+        private_subnets = vpc.private_subnets
+        private_subnet_ids = [s.subnet_id for s in private_subnets]
+
         # The masters role will be granted permission to view and modify cluster resources
         masters_role = iam.Role(
             self,
@@ -183,15 +386,18 @@ class Application(cdk.Stack):
         )
 
         # Provision a Kubernetes cluster
+        # The kubectl layer is a lambda LayerVersion, which has to be created inside a Stack, and stages can't
+        # reference each other's resources, so it can't be shared at the App level. Its asset is content addressed
+        # though, so additional stages reuse the already staged zip and the same S3 object.
         self.cluster = eks.Cluster(
             self,
             "Cluster",
             version=eks.KubernetesVersion.V1_29,
             kubectl_layer=KubectlLayer(self, "kubectl-layer"),
             masters_role=masters_role,
-            output_masters_role_arn=True,
-            output_cluster_name=True,
-            output_config_command=True,
+            output_masters_role_arn=stack_outputs,
+            output_cluster_name=stack_outputs,
+            output_config_command=stack_outputs,
             default_capacity=0,
             cluster_logging=[
                 eks.ClusterLoggingTypes.SCHEDULER,
@@ -208,32 +414,35 @@ class Application(cdk.Stack):
             tags=kwargs.get("tags", []),
         )
 
-        # Apply tags to VPC private subnets to enable EKS managed load balancers
-        cr.AwsCustomResource(
-            self,
-            "SetSubnetTagElb",
-            on_create=cr.AwsSdkCall(
-                service="EC2",
-                action="CreateTags",
-                parameters={
-                    "Resources": [s.subnet_id for s in vpc.private_subnets],
-                    "Tags": [
-                        {"Key": "kubernetes.io/role/internal-elb", "Value": "1"},
-                        {"Key": f"kubernetes.io/cluster/{self.cluster.cluster_name}", "Value": "shared"},
-                    ],
-                },
-                physical_resource_id=cr.PhysicalResourceId.of(f"{vpc.vpc_id}-{self.cluster.cluster_name}"),
-            ),
-            on_delete=cr.AwsSdkCall(
-                service="EC2",
-                action="DeleteTags",
-                parameters={
-                    "Resources": [s.subnet_id for s in vpc.private_subnets],
-                    "Tags": [{"Key": f"kubernetes.io/cluster/{self.cluster.cluster_name}"}],
-                },
-            ),
-            policy=cr.AwsCustomResourcePolicy.from_sdk_calls(resources=cr.AwsCustomResourcePolicy.ANY_RESOURCE),
-        )
+        # Apply tags to VPC private subnets to enable EKS managed load balancers. eks.Cluster already tags subnets of
+        # a VPC created in this app with cdk.Tags, which needs no custom resource. Subnets of an imported VPC aren't
+        # part of any stack, so they are tagged through the EC2 api instead.
+        if not all(ec2.Subnet.is_vpc_subnet(s) for s in private_subnets):
+            cr.AwsCustomResource(
+                self,
+                "SetSubnetTagElb",
+                on_create=cr.AwsSdkCall(
+                    service="EC2",
+                    action="CreateTags",
+                    parameters={
+                        "Resources": private_subnet_ids,
+                        "Tags": [
+                            {"Key": "kubernetes.io/role/internal-elb", "Value": "1"},
+                            {"Key": f"kubernetes.io/cluster/{self.cluster.cluster_name}", "Value": "shared"},
+                        ],
+                    },
+                    physical_resource_id=cr.PhysicalResourceId.of(f"{vpc.vpc_id}-{self.cluster.cluster_name}"),
+                ),
+                on_delete=cr.AwsSdkCall(
+                    service="EC2",
+                    action="DeleteTags",
+                    parameters={
+                        "Resources": private_subnet_ids,
+                        "Tags": [{"Key": f"kubernetes.io/cluster/{self.cluster.cluster_name}"}],
+                    },
+                ),
+                policy=cr.AwsCustomResourcePolicy.from_sdk_calls(resources=cr.AwsCustomResourcePolicy.ANY_RESOURCE),
+            )
 
         # Grant masters role necessary permissions
         masters_role.add_to_policy(
@@ -243,6 +452,13 @@ class Application(cdk.Stack):
             )
         )
 
+        # Permissions the cluster-autoscaler needs, which only scales the system node group
+        autoscaler_policy = iam.ManagedPolicy(
+            self,
+            "ClusterAutoscalerPolicy",
+            statements=[iam.PolicyStatement(actions=CLUSTER_AUTOSCALER_ACTIONS, resources=["*"])],
+        )
+
         system_node_group = self.cluster.add_nodegroup_capacity(
             "SystemNodeGroup",
             min_size=SYSTEM_AUTOSCALING_GROUP_MIN_SIZE,
@@ -252,242 +468,162 @@ class Application(cdk.Stack):
         system_node_group.role.add_managed_policy(
             iam.ManagedPolicy.from_aws_managed_policy_name("SecretsManagerReadWrite")
         )
-        system_node_group.role.add_to_principal_policy(
-            iam.PolicyStatement(
-                actions=[
-                    "autoscaling:DescribeAutoScalingGroups",
-                    "autoscaling:DescribeAutoScalingInstances",
-                    "autoscaling:DescribeLaunchConfigurations",
-                    "autoscaling:DescribeScalingActivities",
-                    "autoscaling:DescribeTags",
-                    "ec2:DescribeInstanceTypes",
-                    "ec2:DescribeLaunchTemplateVersions",
-                    "autoscaling:SetDesiredCapacity",
-                    "autoscaling:TerminateInstanceInAutoScalingGroup",
-                    "ec2:DescribeImages",
-                    "ec2:GetInstanceTypesFromInstanceRequirements",
-                    "eks:DescribeNodegroup",
-                ],
-                resources=["*"],
-            )
-        )
-
-        # Autoscaling is managed via an AWS managed node group and K8s ClusterAutoscaler.
-        user_node_group = self.cluster.add_nodegroup_capacity(
-            "UserNodeGroup",
-            min_size=USER_AUTOSCALING_GROUP_MIN_SIZE,
-            max_size=USER_AUTOSCALING_GROUP_MAX_SIZE,
-            instance_types=[user_node_instance_type],
-            labels={"hub.jupyter.org/node-purpose": "user"},
-            taints=[eks.TaintSpec(effect=eks.TaintEffect.NO_SCHEDULE, key="hub.jupyter.org/dedicated", value="user")],
-        )
-        user_node_group.role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("SecretsManagerReadWrite")
-        )
-        user_node_group.role.add_to_principal_policy(
-            iam.PolicyStatement(
-                actions=[
-                    "autoscaling:DescribeAutoScalingGroups",
-                    "autoscaling:DescribeAutoScalingInstances",
-                    "autoscaling:DescribeLaunchConfigurations",
-                    "autoscaling:DescribeScalingActivities",
-                    "autoscaling:DescribeTags",
-                    "ec2:DescribeInstanceTypes",
-                    "ec2:DescribeLaunchTemplateVersions",
-                    "autoscaling:SetDesiredCapacity",
-                    "autoscaling:TerminateInstanceInAutoScalingGroup",
-                    "ec2:DescribeImages",
-                    "ec2:GetInstanceTypesFromInstanceRequirements",
-                    "eks:DescribeNodegroup",
-                ],
-                resources=["*"],
-            )
-        )
+        system_node_group.role.add_managed_policy(autoscaler_policy)
 
-        r = requests.get(
-            "https://raw.githubusercontent.com/kubernetes/autoscaler/master/cluster-autoscaler/cloudprovider/aws/examples/cluster-autoscaler-autodiscover.yaml"
+        # Stacks that won't be deployed, e.g. during `cdk ls` or `cdk destroy`, don't need an up to date manifest
+        manifest_yaml = _load_autoscaler_manifest(
+            max_age=CLUSTER_AUTOSCALER_MANIFEST_MAX_AGE if self.bundling_required else None
         )
-        manifest_yaml = r.text
         manifest_yaml = manifest_yaml.replace("<YOUR CLUSTER NAME>", self.cluster.cluster_name)
-        autoscaler_manifests = yaml.full_load_all(manifest_yaml)
-        self.cluster.add_manifest("Autoscaler", *autoscaler_manifests)
+        # Drop empty documents, e.g. from a trailing "---", which would otherwise be passed on as null manifests
+        autoscaler_manifests = [doc for doc in yaml.load_all(manifest_yaml, Loader=_yaml_loader()) if doc]
 
-        # Set up EFS driver
-        oid_connect_issuer_id = self.cluster.open_id_connect_provider.open_id_connect_provider_issuer.replace(
-            "https://", ""
-        )
-        efs_csi_addon_role_policy_condition = cdk.CfnJson(
-            self,
-            "EfsAddonPolicyCondition",
-            value={
-                f"{oid_connect_issuer_id}:aud": "sts.amazonaws.com",
-                f"{oid_connect_issuer_id}:sub": "system:serviceaccount:kube-system:efs-csi-*",
-            },
-        )
-        efs_csi_addon_role = iam.Role(
-            self,
-            "EfsAddonRole",
-            assumed_by=iam.FederatedPrincipal(
-                federated=self.cluster.open_id_connect_provider.open_id_connect_provider_arn,
-                conditions={"StringLike": efs_csi_addon_role_policy_condition},
-                assume_role_action="sts:AssumeRoleWithWebIdentity",
-            ),
-        )
-        efs_csi_addon_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AmazonEFSCSIDriverPolicy")
-        )
-        efs_csi_addon = eks.CfnAddon(
+        # EKS Pod Identity agent, which hands out IAM role credentials to service accounts with a pod identity
+        # association. Unlike IRSA, the trust policies don't depend on the cluster's OIDC issuer, so no CfnJson
+        # custom resources are needed to build them.
+        self._pod_identity_agent = eks.CfnAddon(
             self,
-            "EfsCsiAddon",
-            addon_name="aws-efs-csi-driver",
+            "PodIdentityAgentAddon",
+            addon_name="eks-pod-identity-agent",
             cluster_name=self.cluster.cluster_name,
-            service_account_role_arn=efs_csi_addon_role.role_arn,
         )
-        efs_csi_addon.apply_removal_policy(removal_policy)
+        self._pod_identity_agent.apply_removal_policy(removal_policy)
 
-        # Cloudwatch Observability Addon
-        cloudwatch_addon_role_policy_condition = cdk.CfnJson(
-            self,
-            "CloudwatchAddonPolicyCondition",
-            value={
-                f"{oid_connect_issuer_id}:aud": "sts.amazonaws.com",
-                f"{oid_connect_issuer_id}:sub": "system:serviceaccount:kube-system:cloudwatch*",
-            },
-        )
-        cloudwatch_addon_role = iam.Role(
-            self,
-            "CloudWatchObservabilityRole",
-            assumed_by=iam.FederatedPrincipal(
-                federated=self.cluster.open_id_connect_provider.open_id_connect_provider_arn,
-                conditions={"StringLike": cloudwatch_addon_role_policy_condition},
-                assume_role_action="sts:AssumeRoleWithWebIdentity",
-            ),
-        )
-        cloudwatch_addon_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("AWSXrayWriteOnlyAccess")
+        # Set up EFS driver
+        self._add_addon(
+            "aws-efs-csi-driver",
+            addon_id="EfsCsiAddon",
+            role_id="EfsAddonRole",
+            service_accounts=["efs-csi-controller-sa", "efs-csi-node-sa"],
+            managed_policy_names=["service-role/AmazonEFSCSIDriverPolicy"],
+            removal_policy=removal_policy,
         )
-        cloudwatch_addon_role.add_managed_policy(
-            iam.ManagedPolicy.from_aws_managed_policy_name("CloudWatchAgentServerPolicy")
+
+        # Cloudwatch Observability Addon
+        self._add_addon(
+            "amazon-cloudwatch-observability",
+            addon_id="CloudWatchObservabilityAddon",
+            role_id="CloudWatchObservabilityRole",
+            service_accounts=["cloudwatch-agent"],
+            managed_policy_names=["AWSXrayWriteOnlyAccess", "CloudWatchAgentServerPolicy"],
+            removal_policy=removal_policy,
         )
 
-        cloudwatch_addon = eks.CfnAddon(
+        # User servers run on nodes Karpenter launches as they are needed
+        self._add_karpenter(user_node_instance_type, private_subnet_ids)
+
+        # User environment role
+        user_service_account_name = "jupyterhub-user"
+        user_role = self._pod_identity_role("JupyterhubUserRole")
+        eks.CfnPodIdentityAssociation(
             self,
-            "CloudWatchObservabilityAddon",
-            addon_name="amazon-cloudwatch-observability",
+            "JupyterhubUserPodIdentityAssociation",
             cluster_name=self.cluster.cluster_name,
-            service_account_role_arn=cloudwatch_addon_role.role_arn,
+            namespace="jupyterhub",
+            service_account=user_service_account_name,
+            role_arn=user_role.role_arn,
         )
-        cloudwatch_addon.apply_removal_policy(removal_policy)
+        if stack_outputs:
+            cdk.CfnOutput(
+                self,
+                "JupyterhubUserRoleArn",
+                value=user_role.role_arn,
+                description="Jupyterhub hub user execution role arn",
+            )
 
-        eks_namespace = self.cluster.add_manifest(
-            "EksNamespace",
-            {
-                "apiVersion": "v1",
-                "kind": "Namespace",
-                "metadata": {"name": "jupyterhub"},
+        namespace = {
+            "apiVersion": "v1",
+            "kind": "Namespace",
+            "metadata": {"name": "jupyterhub"},
+        }
+        efs_storage_class = {
+            "apiVersion": "storage.k8s.io/v1",
+            "kind": "StorageClass",
+            "metadata": {"name": "efs", "namespace": "jupyterhub"},
+            "provisioner": "efs.csi.aws.com",
+            "parameters": {
+                "provisioningMode": "efs-ap",
+                "fileSystemId": file_system.file_system_id,
+                "directoryPerms": "700",
             },
-        )
-
-        efs_storage_class = self.cluster.add_manifest(
-            "EfsStorageClass",
-            {
-                "apiVersion": "storage.k8s.io/v1",
-                "kind": "StorageClass",
-                "metadata": {"name": "efs", "namespace": "jupyterhub"},
-                "provisioner": "efs.csi.aws.com",
-                "parameters": {
-                    "provisioningMode": "efs-ap",
-                    "fileSystemId": file_system.file_system_id,
-                    "directoryPerms": "700",
-                },
+        }
+        efs_shared_volume_claim = {
+            "apiVersion": "v1",
+            "kind": "PersistentVolumeClaim",
+            "metadata": {"name": "jupyterhub-shared-claim", "namespace": "jupyterhub"},
+            "spec": {
+                "storageClassName": "efs",
+                "accessModes": ["ReadWriteMany"],
+                "resources": {"requests": {"storage": "100Gi"}},
             },
-        )
-        efs_storage_class.node.add_dependency(eks_namespace)
+        }
+        user_service_account = {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {"name": user_service_account_name, "namespace": "jupyterhub"},
+        }
 
-        efs_shared_volume_claim = self.cluster.add_manifest(
-            "EfsSharedVolumeClaim",
-            {
-                "apiVersion": "v1",
-                "kind": "PersistentVolumeClaim",
-                "metadata": {"name": "jupyterhub-shared-claim", "namespace": "jupyterhub"},
-                "spec": {
-                    "storageClassName": "efs",
-                    "accessModes": ["ReadWriteMany"],
-                    "resources": {"requests": {"storage": "100Gi"}},
-                },
-            },
+        # Namespace, shared EFS storage, the user service account and the cluster-autoscaler, applied in order by a
+        # single kubectl invocation, as each KubernetesManifest is a separate run of the kubectl lambda. Skip kubectl's
+        # pruning and server side validation, so objects dropped from this list have to be deleted by hand. Scoped the
+        # same way as cluster.add_manifest.
+        jupyterhub_bootstrap = eks.KubernetesManifest(
+            self.cluster,
+            "manifest-JupyterhubBootstrap",
+            cluster=self.cluster,
+            prune=False,
+            skip_validation=True,
+            manifest=[
+                namespace,
+                efs_storage_class,
+                efs_shared_volume_claim,
+                user_service_account,
+                *autoscaler_manifests,
+            ],
         )
-        efs_shared_volume_claim.node.add_dependency(efs_storage_class)
 
-        # User environment role
-        user_service_account_name = "jupyterhub-user"
-        user_eks_principal_condition = cdk.CfnJson(
-            self,
-            "SingleUserServiceAccountPolicyCondition",
-            value={
-                f"{oid_connect_issuer_id}:aud": "sts.amazonaws.com",
-                f"{oid_connect_issuer_id}:sub": f"system:serviceaccount:jupyterhub:{user_service_account_name}",
-            },
-        )
-        user_eks_principal = iam.FederatedPrincipal(
-            federated=self.cluster.open_id_connect_provider.open_id_connect_provider_arn,
-            conditions={"StringLike": user_eks_principal_condition},
-            assume_role_action="sts:AssumeRoleWithWebIdentity",
-        )
-        user_role = iam.Role(self, "JupyterhubUserRole", assumed_by=user_eks_principal)
-        user_service_account = self.cluster.add_manifest(
-            "SingleUserServiceAccount",
-            {
-                "apiVersion": "v1",
-                "kind": "ServiceAccount",
-                "metadata": {
-                    "name": user_service_account_name,
-                    "namespace": "jupyterhub",
-                    "annotations": {"eks.amazonaws.com/role-arn": user_role.role_arn},
-                },
-            },
-        )
-        user_service_account.node.add_dependency(eks_namespace)
-        cdk.CfnOutput(
-            self,
-            "JupyterhubUserRoleArn",
-            value=user_role.role_arn,
-            description="Jupyterhub hub user execution role arn",
-        )
+        # Stacks deployed before the bootstrap manifest applied these objects through manifests of their own. Dropping
+        # those from the template would make CloudFormation run kubectl delete on them, deleting the namespace with
+        # the hub in it, the shared volume, the user service account and the cluster-autoscaler. Such stacks are
+        # deployed once with the retain_legacy_manifests context flag, which keeps them with a RETAIN policy, so the
+        # next deploy without it drops them without deleting anything. See "Upgrading" in the README.
+        if str(self.node.try_get_context("retain_legacy_manifests")).lower() in ("1", "on", "true"):
+            legacy_manifests = {
+                "EksNamespace": [namespace],
+                "EfsStorageClass": [efs_storage_class],
+                "EfsSharedVolumeClaim": [efs_shared_volume_claim],
+                "SingleUserServiceAccount": [user_service_account],
+                "Autoscaler": autoscaler_manifests,
+            }
+            for legacy_id, legacy_documents in legacy_manifests.items():
+                legacy_manifest = self.cluster.add_manifest(legacy_id, *legacy_documents)
+                legacy_manifest.node.add_dependency(jupyterhub_bootstrap)
+                legacy_resource = cast(cdk.CustomResource, legacy_manifest.node.default_child)
+                legacy_resource.apply_removal_policy(cdk.RemovalPolicy.RETAIN)
 
         # Build and deploy custom docker images
-        user_image = ecr_assets.DockerImageAsset(
+        netrc_secret = {"netrc": f"src={os.environ['HOME']}/.netrc"}
+        user_image = _docker_image(
             self,
             "UserServerBaseImage",
-            directory="images",
-            file="user.Dockerfile",
-            platform=ecr_assets.Platform.LINUX_AMD64,
-            build_secrets={"netrc": f"src={os.environ['HOME']}/.netrc"},
+            "user.Dockerfile",
+            build_secrets=netrc_secret,
             build_ssh="default",
         )
-        hub_image = ecr_assets.DockerImageAsset(
+        hub_image = _docker_image(
             self,
             "HubBaseImage",
-            directory="images",
-            file="hub.Dockerfile",
-            platform=ecr_assets.Platform.LINUX_AMD64,
-            build_secrets={"netrc": f"src={os.environ['HOME']}/.netrc"},
+            "hub.Dockerfile",
+            build_secrets=netrc_secret,
             build_ssh="default",
         )
         # Copy Traifik Image to ECR to avoid rate limit errors from Dockerhub
-        traefik_image = ecr_assets.DockerImageAsset(
-            self,
-            "TraefikImage",
-            directory="images",
-            file="traefik.Dockerfile",
-            platform=ecr_assets.Platform.LINUX_AMD64,
-        )
-
-        config_template = jinja_env.get_template("config.yaml.j2")
-        config_secrets_template = jinja_env.get_template("config_secrets.py.j2")
+        traefik_image = _docker_image(self, "TraefikImage", "traefik.Dockerfile")
 
+        config_template = _jinja().get_template("config.yaml.j2")
+        config_secrets_template = _jinja().get_template("config_secrets.py.j2")
         config_secrets_script = config_secrets_template.render(hub_db_secret_arn=hub_db_secret_arn)
-        config = yaml.full_load(
+        config = yaml.load(
             config_template.render(
                 user_image_repository_uri=user_image.repository.repository_uri,
                 user_image_tag=user_image.image_tag,
@@ -496,9 +632,10 @@ class Application(cdk.Stack):
                 traefik_image_repository_uri=traefik_image.repository.repository_uri,
                 traefik_image_tag=traefik_image.image_tag,
                 user_service_account_name=user_service_account_name,
-            )
+            ),
+            Loader=_yaml_loader(),
         )
-        config["hub"]["extraConfig"] = {"config_secrets.py": config_secrets_script}
+        config = _deep_merge(config, {"hub": {"extraConfig": {"config_secrets.py": config_secrets_script}}})
 
         # Deploy Jupyterhub helm chart
         jupyterhub = eks.HelmChart(
@@ -511,19 +648,362 @@ class Application(cdk.Stack):
             create_namespace=True,
             release="jupyterhub",
             version="3.2.1",
-            wait=True,
+            # Don't hold the kubectl handler until every pod is ready, the endpoint lookup below polls on its own
+            wait=False,
+            # helm still waits for the chart's pre-upgrade hooks, and the image puller hook pulls the user image onto
+            # every user node. Allow more than the 5 minute default, within the handler's 15 minute limit.
+            timeout=cdk.Duration.minutes(10),
             values=config,
         )
-        jupyterhub.node.add_dependency(efs_storage_class)
+        jupyterhub.node.add_dependency(jupyterhub_bootstrap)
+
+        # Expose service endpoint as stack output, polling until the load balancer has been provisioned
+        if stack_outputs:
+            jupyterhub_endpoint = eks.KubernetesObjectValue(
+                self,
+                "JupyterhubEndpointValue",
+                cluster=self.cluster,
+                object_type="service",
+                object_name="proxy-public",
+                object_namespace="jupyterhub",
+                json_path=".status.loadBalancer.ingress[0].hostname",
+                timeout=cdk.Duration.minutes(10),
+            )
+            jupyterhub_endpoint.node.add_dependency(jupyterhub)
+            cdk.CfnOutput(
+                self,
+                "JupyterhubEndpoint",
+                value=jupyterhub_endpoint.value,
+                description="The web address of the Jupyterhub load balancer.",
+            )
+
+    def _pod_identity_role(self, id: str) -> iam.Role:
+        """Create an IAM role that EKS Pod Identity associations can hand out to service accounts.
+
+        Args:
+            id: Construct id of the role
+        """
+        return iam.Role(
+            self,
+            id,
+            assumed_by=iam.SessionTagsPrincipal(iam.ServicePrincipal("pods.eks.amazonaws.com")),
+        )
+
+    def _add_karpenter(self, user_node_instance_type: ec2.InstanceType, subnet_ids: list[str]) -> eks.HelmChart:
+        """Install Karpenter, with a node pool for the nodes user servers run on.
+
+        Karpenter launches nodes sized to the pending pods with EC2 fleet requests, instead of resizing an autoscaling
+        group, so a burst of new user sessions is brought up in a batch.
+
+        Args:
+            user_node_instance_type: ec2 instance type of the user nodes
+            subnet_ids: ids of the subnets to launch user nodes in
+        """
+        node_role = iam.Role(self, "KarpenterNodeRole", assumed_by=iam.ServicePrincipal("ec2.amazonaws.com"))
+        for managed_policy_name in [
+            "AmazonEKSWorkerNodePolicy",
+            "AmazonEKS_CNI_Policy",
+            "AmazonEC2ContainerRegistryReadOnly",
+            "AmazonSSMManagedInstanceCore",
+            "SecretsManagerReadWrite",
+        ]:
+            node_role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name(managed_policy_name))
+        self.cluster.aws_auth.add_role_mapping(
+            node_role,
+            groups=["system:bootstrappers", "system:nodes"],
+            username="system:node:{{EC2PrivateDNSName}}",
+        )
+
+        # The controller's permissions follow Karpenter's reference policy, minus the interruption queue actions. They
+        # are scoped to the resources Karpenter tags as owned by this cluster, and as the tag key contains the cluster
+        # name, which is only known at deploy time, each set of conditions is built with a CfnJson custom resource.
+        cluster_name = self.cluster.cluster_name
+        cluster_tag = f"kubernetes.io/cluster/{cluster_name}"
+        eks_cluster_name_tag = "eks:eks-cluster-name"
+        region_tag = "topology.kubernetes.io/region"
+        ec2_arn = f"arn:{self.partition}:ec2:{self.region}"
+        tagged_ec2_resources = [
+            f"{ec2_arn}:*:{resource_type}/*"
+            for resource_type in [
+                "fleet",
+                "instance",
+                "volume",
+                "network-interface",
+                "launch-template",
+                "spot-instances-request",
+            ]
+        ]
+        instance_profiles = f"arn:{self.partition}:iam::{self.account}:instance-profile/*"
+        owned_resource_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedResourceCondition",
+            value={f"aws:ResourceTag/{cluster_tag}": "owned"},
+        )
+        owned_request_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedRequestCondition",
+            value={
+                f"aws:RequestTag/{cluster_tag}": "owned",
+                f"aws:RequestTag/{eks_cluster_name_tag}": cluster_name,
+            },
+        )
+        owned_creation_tagging_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedCreationTaggingCondition",
+            value={
+                f"aws:RequestTag/{cluster_tag}": "owned",
+                f"aws:RequestTag/{eks_cluster_name_tag}": cluster_name,
+                "ec2:CreateAction": ["RunInstances", "CreateFleet", "CreateLaunchTemplate"],
+            },
+        )
+        owned_instance_profile_request_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedInstanceProfileRequestCondition",
+            value={
+                f"aws:RequestTag/{cluster_tag}": "owned",
+                f"aws:RequestTag/{eks_cluster_name_tag}": cluster_name,
+                f"aws:RequestTag/{region_tag}": self.region,
+            },
+        )
+        owned_instance_profile_tagging_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedInstanceProfileTaggingCondition",
+            value={
+                f"aws:ResourceTag/{cluster_tag}": "owned",
+                f"aws:ResourceTag/{region_tag}": self.region,
+                f"aws:RequestTag/{cluster_tag}": "owned",
+                f"aws:RequestTag/{eks_cluster_name_tag}": cluster_name,
+                f"aws:RequestTag/{region_tag}": self.region,
+            },
+        )
+        owned_instance_profile_resource_condition = cdk.CfnJson(
+            self,
+            "KarpenterOwnedInstanceProfileResourceCondition",
+            value={
+                f"aws:ResourceTag/{cluster_tag}": "owned",
+                f"aws:ResourceTag/{region_tag}": self.region,
+            },
+        )
+
+        controller_role = self._pod_identity_role("KarpenterControllerRole")
+        for statement in [
+            # Launching nodes
+            iam.PolicyStatement(
+                actions=["ec2:RunInstances", "ec2:CreateFleet"],
+                resources=[
+                    f"{ec2_arn}::image/*",
+                    f"{ec2_arn}::snapshot/*",
+                    f"{ec2_arn}:*:security-group/*",
+                    f"{ec2_arn}:*:subnet/*",
+                ],
+            ),
+            iam.PolicyStatement(
+                actions=["ec2:RunInstances", "ec2:CreateFleet"],
+                resources=[f"{ec2_arn}:*:launch-template/*"],
+                conditions={
+                    "StringEquals": owned_resource_condition,
+                    "StringLike": {"aws:ResourceTag/karpenter.sh/nodepool": "*"},
+                },
+            ),
+            iam.PolicyStatement(
+                actions=["ec2:RunInstances", "ec2:CreateFleet", "ec2:CreateLaunchTemplate"],
+                resources=tagged_ec2_resources,
+                conditions={
+                    "StringEquals": owned_request_condition,
+                    "StringLike": {"aws:RequestTag/karpenter.sh/nodepool": "*"},
+                },
+            ),
+            iam.PolicyStatement(
+                actions=["ec2:CreateTags"],
+                resources=tagged_ec2_resources,
+                conditions={
+                    "StringEquals": owned_creation_tagging_condition,
+                    "StringLike": {"aws:RequestTag/karpenter.sh/nodepool": "*"},
+                },
+            ),
+            iam.PolicyStatement(
+                actions=["ec2:CreateTags"],
+                resources=[f"{ec2_arn}:*:instance/*"],
+                conditions={
+                    "StringEquals": owned_resource_condition,
+                    "StringLike": {"aws:ResourceTag/karpenter.sh/nodepool": "*"},
+                    "StringEqualsIfExists": {f"aws:RequestTag/{eks_cluster_name_tag}": cluster_name},
+                    "ForAllValues:StringEquals": {
+                        "aws:TagKeys": [eks_cluster_name_tag, "karpenter.sh/nodeclaim", "Name"]
+                    },
+                },
+            ),
+            # Removing nodes
+            iam.PolicyStatement(
+                actions=["ec2:TerminateInstances", "ec2:DeleteLaunchTemplate"],
+                resources=[f"{ec2_arn}:*:instance/*", f"{ec2_arn}:*:launch-template/*"],
+                conditions={
+                    "StringEquals": owned_resource_condition,
+                    "StringLike": {"aws:ResourceTag/karpenter.sh/nodepool": "*"},
+                },
+            ),
+            # Choosing instance types, AMIs, subnets and security groups
+            iam.PolicyStatement(
+                actions=KARPENTER_REGIONAL_READ_ACTIONS,
+                resources=["*"],
+                conditions={"StringEquals": {"aws:RequestedRegion": self.region}},
+            ),
+            iam.PolicyStatement(
+                actions=["ssm:GetParameter"],
+                resources=[f"arn:{self.partition}:ssm:{self.region}::parameter/aws/service/*"],
+            ),
+            iam.PolicyStatement(actions=["pricing:GetProducts"], resources=["*"]),
+            # Managing the instance profile of the node role
+            iam.PolicyStatement(
+                actions=["iam:PassRole"],
+                resources=[node_role.role_arn],
+                conditions={"StringEquals": {"iam:PassedToService": "ec2.amazonaws.com"}},
+            ),
+            iam.PolicyStatement(
+                actions=["iam:CreateInstanceProfile"],
+                resources=[instance_profiles],
+                conditions={
+                    "StringEquals": owned_instance_profile_request_condition,
+                    "StringLike": {"aws:RequestTag/karpenter.k8s.aws/ec2nodeclass": "*"},
+                },
+            ),
+            iam.PolicyStatement(
+                actions=["iam:TagInstanceProfile"],
+                resources=[instance_profiles],
+                conditions={
+                    "StringEquals": owned_instance_profile_tagging_condition,
+                    "StringLike": {
+                        "aws:ResourceTag/karpenter.k8s.aws/ec2nodeclass": "*",
+                        "aws:RequestTag/karpenter.k8s.aws/ec2nodeclass": "*",
+                    },
+                },
+            ),
+            iam.PolicyStatement(
+                actions=[
+                    "iam:AddRoleToInstanceProfile",
+                    "iam:RemoveRoleFromInstanceProfile",
+                    "iam:DeleteInstanceProfile",
+                ],
+                resources=[instance_profiles],
+                conditions={
+                    "StringEquals": owned_instance_profile_resource_condition,
+                    "StringLike": {"aws:ResourceTag/karpenter.k8s.aws/ec2nodeclass": "*"},
+                },
+            ),
+            iam.PolicyStatement(actions=["iam:GetInstanceProfile"], resources=[instance_profiles]),
+            # Discovering the cluster's API server endpoint
+            iam.PolicyStatement(actions=["eks:DescribeCluster"], resources=[self.cluster.cluster_arn]),
+        ]:
+            controller_role.add_to_policy(statement)
+        association = eks.CfnPodIdentityAssociation(
+            self,
+            "KarpenterPodIdentityAssociation",
+            cluster_name=self.cluster.cluster_name,
+            namespace="kube-system",
+            service_account="karpenter",
+            role_arn=controller_role.role_arn,
+        )
+
+        karpenter = eks.HelmChart(
+            self,
+            "KarpenterHelmChart",
+            cluster=self.cluster,
+            chart="karpenter",
+            repository="oci://public.ecr.aws/karpenter/karpenter",
+            namespace="kube-system",
+            release="karpenter",
+            version=KARPENTER_VERSION,
+            values={
+                "settings": {"clusterName": self.cluster.cluster_name},
+                # The controller is leader elected, and its replicas can't share a node. Run one, so it fits on the
+                # system node group's minimum size.
+                "replicas": 1,
+                "controller": {"env": [{"name": "AWS_REGION", "value": self.region}]},
+            },
+        )
+        # EKS only injects pod identity credentials into pods created after their association exists
+        karpenter.node.add_dependency(self._pod_identity_agent, association)
+
+        # The CRDs these are instances of are installed by the chart
+        user_node_pool = self.cluster.add_manifest(
+            "KarpenterUserNodePool",
+            {
+                "apiVersion": "karpenter.k8s.aws/v1",
+                "kind": "EC2NodeClass",
+                "metadata": {"name": "user"},
+                "spec": {
+                    "role": node_role.role_name,
+                    "amiSelectorTerms": [{"alias": "al2023@latest"}],
+                    "subnetSelectorTerms": [{"id": subnet_id} for subnet_id in subnet_ids],
+                    "securityGroupSelectorTerms": [{"id": self.cluster.cluster_security_group_id}],
+                },
+            },
+            {
+                "apiVersion": "karpenter.sh/v1",
+                "kind": "NodePool",
+                "metadata": {"name": "user"},
+                "spec": {
+                    "template": {
+                        "metadata": {"labels": {"hub.jupyter.org/node-purpose": "user"}},
+                        "spec": {
+                            "nodeClassRef": {"group": "karpenter.k8s.aws", "kind": "EC2NodeClass", "name": "user"},
+                            "taints": [{"key": "hub.jupyter.org/dedicated", "value": "user", "effect": "NoSchedule"}],
+                            "requirements": [
+                                {
+                                    "key": "node.kubernetes.io/instance-type",
+                                    "operator": "In",
+                                    "values": [user_node_instance_type.to_string()],
+                                },
+                                {"key": "karpenter.sh/capacity-type", "operator": "In", "values": ["on-demand"]},
+                            ],
+                            # Nodes run user sessions, don't replace them while they are in use
+                            "expireAfter": "Never",
+                        },
+                    },
+                    "disruption": {"consolidationPolicy": "WhenEmpty", "consolidateAfter": "10m"},
+                    "limits": {"cpu": USER_NODE_POOL_CPU_LIMIT},
+                },
+            },
+        )
+        user_node_pool.node.add_dependency(karpenter)
+        return karpenter
 
-        # Expose service endpoint as stack output
-        jupyterhub_endpoint = self.cluster.get_service_load_balancer_address("proxy-public", namespace="jupyterhub")
-        cdk.CfnOutput(
+    def _add_addon(
+        self,
+        addon_name: str,
+        addon_id: str,
+        role_id: str,
+        service_accounts: list[str],
+        managed_policy_names: list[str],
+        removal_policy: cdk.RemovalPolicy,
+    ) -> eks.CfnAddon:
+        """Install an EKS addon whose service accounts assume a dedicated IAM role through EKS Pod Identity.
+
+        Args:
+            addon_name: Name of the EKS addon to install
+            addon_id: Construct id of the addon
+            role_id: Construct id of the addon's IAM role
+            service_accounts: Names of the addon's service accounts allowed to assume the role
+            managed_policy_names: AWS managed policies to attach to the addon's role
+            removal_policy: cdk removal policy for the addon
+        """
+        role = self._pod_identity_role(role_id)
+        for managed_policy_name in managed_policy_names:
+            role.add_managed_policy(iam.ManagedPolicy.from_aws_managed_policy_name(managed_policy_name))
+
+        addon = eks.CfnAddon(
             self,
-            "JupyterhubEndpoint",
-            value=jupyterhub_endpoint,
-            description="The web address of the Jupyterhub load balancer.",
+            addon_id,
+            addon_name=addon_name,
+            cluster_name=self.cluster.cluster_name,
+            pod_identity_associations=[
+                eks.CfnAddon.PodIdentityAssociationProperty(role_arn=role.role_arn, service_account=service_account)
+                for service_account in service_accounts
+            ],
         )
+        addon.apply_removal_policy(removal_policy)
+        addon.add_dependency(self._pod_identity_agent)
+        return addon
 
 
 class Jupyterhub(cdk.Stage):
@@ -538,6 +1018,7 @@ class Jupyterhub(cdk.Stage):
         system_node_instance_type: ec2.InstanceType,
         vpc_id: str | None = None,
         tags: dict[str, str] | None = None,
+        stack_outputs: bool = True,
         **kwargs,
     ) -> Self:
         """Initialize a Jupyterhub application.
@@ -550,6 +1031,7 @@ class Jupyterhub(cdk.Stage):
             user_node_instance_type: ec2 instance type of nodes running user servers in k8s cluster
             system_node_instance_type: ec2 instance type of nodes running system pods in k8s cluster
             vpc_id: ID of the vpc in which to create this application, if None, a new vpc will be created
+            stack_outputs: Whether to emit the cluster access, user role and endpoint stack outputs
         """
         super().__init__(scope, id, **kwargs)
 
@@ -562,6 +1044,7 @@ class Jupyterhub(cdk.Stage):
             self,
             "Database",
             vpc=vpc.vpc,
+            vpc_cidr_block=vpc.vpc_cidr_block,
             removal_policy=removal_policy,
             instance_type=db_instance_type,
             tags=tags,
@@ -572,6 +1055,7 @@ class Jupyterhub(cdk.Stage):
             self,
             "FileSystem",
             vpc=vpc.vpc,
+            vpc_cidr_block=vpc.vpc_cidr_block,
             automatic_backups=automatic_backups,
             removal_policy=removal_policy,
             tags=tags,
@@ -587,13 +1071,17 @@ class Jupyterhub(cdk.Stage):
             hub_db_secret_arn=database.db.secret.secret_arn,
             user_node_instance_type=user_node_instance_type,
             system_node_instance_type=system_node_instance_type,
+            stack_outputs=stack_outputs,
             tags=tags,
             termination_protection=termination_protection,
         )
 
 
 if __name__ == "__main__":
-    app = cdk.App()
+    # Don't record a stack trace in the metadata of every CloudFormation resource, so synth errors lose their python
+    # file/line info. `cdk --debug` sets CDK_DEBUG to keep them, parsed the same way CDK parses it.
+    cdk_debug = os.environ.get("CDK_DEBUG", "").lower() in ("1", "on", "true")
+    app = cdk.App(context={"aws:cdk:disable-stack-trace": not cdk_debug})
 
     Jupyterhub(
         app,
@@ -604,6 +1092,8 @@ if __name__ == "__main__":
         db_instance_type=ec2.InstanceType.of(ec2.InstanceClass.BURSTABLE4_GRAVITON, ec2.InstanceSize.MICRO),
         user_node_instance_type=ec2.InstanceType.of(ec2.InstanceClass.M7I, ec2.InstanceSize.XLARGE),
         system_node_instance_type=ec2.InstanceType.of(ec2.InstanceClass.M7I, ec2.InstanceSize.LARGE),
+        # Set CDK_VERBOSE_OUTPUTS=0 in pipelines that never read output.json
+        stack_outputs=os.environ.get("CDK_VERBOSE_OUTPUTS", "1") == "1",
         env=cdk.Environment(account=os.environ["CDK_DEFAULT_ACCOUNT"], region=os.environ["CDK_DEFAULT_REGION"]),
     )
 